@@ -1,12 +1,15 @@
 
 from collections import defaultdict
-from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import json
 import os
 import shutil
 from pathlib import Path
 
-from zenkit import ModelAnimation, ModelScript
+import numpy as np
+import orjson
+from zenkit import AnimationSample, ModelAnimation, ModelScript
 
 import convert_textures
 import convert_model_hierarchy
@@ -19,8 +22,8 @@ import convert_model_animations
 import convert_worlds
 import helpers
 
-def rf(f, accuracy=4):
-    return round(f, accuracy)
+json_options = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+animation_sample_dtype = np.dtype(AnimationSample)
 
 
 def find_latest_blender():
@@ -30,26 +33,43 @@ def find_latest_blender():
         if not blender_foundation_folder_path.exists():
             continue
 
-        blender_folder_path_list = list(blender_foundation_folder_path.glob(f'*'))
-        blender_folder_path_list = sorted([path for path in blender_folder_path_list if path.is_dir()])
+        with os.scandir(blender_foundation_folder_path) as entries:
+            blender_folder_name_list = sorted([entry.name for entry in entries if entry.is_dir()])
 
-        if len(blender_folder_path_list):
-            return blender_folder_path_list[-1]
+        if len(blender_folder_name_list):
+            return blender_foundation_folder_path / blender_folder_name_list[-1]
 
     return ''
 
 
-def is_continuous_and_non_overlapping(ranges):
-    # Sort by start
-    ranges = sorted(ranges, key=lambda x: x.first_frame)
-    for i in range(1, len(ranges)):
-        prev = ranges[i - 1]
-        curr = ranges[i]
-        if curr.first_frame <= prev.last_frame:  # Overlap
-            return False
-        if curr.first_frame != prev.last_frame + 1:  # Gap
-            return False
-    return True
+def find_longest_anis_chain(sorted_anis, full_start, full_end):
+    # longest chain of anis where every ani starts right after the previous one ends,
+    # on equal length prefer chains starting at the beginning of the full range
+    chain_length = [1] * len(sorted_anis)
+    chain_start = [ani.first_frame for ani in sorted_anis]
+    chain_previous = [-1] * len(sorted_anis)
+    chain_end_by_last_frame = {}
+    for i, ani in enumerate(sorted_anis):
+        previous = chain_end_by_last_frame.get(ani.first_frame - 1)
+        if previous is not None:
+            chain_length[i] = chain_length[previous] + 1
+            chain_start[i] = chain_start[previous]
+            chain_previous[i] = previous
+        current = chain_end_by_last_frame.get(ani.last_frame)
+        if current is None or ((chain_length[i], chain_start[i] == full_start) >
+                               (chain_length[current], chain_start[current] == full_start)):
+            chain_end_by_last_frame[ani.last_frame] = i
+
+    chain = []
+    chain_end = max(range(len(sorted_anis)),
+                    key=lambda i: (chain_length[i], chain_start[i] == full_start and sorted_anis[i].last_frame == full_end))
+    if chain_length[chain_end] > 1:
+        while chain_end != -1:
+            chain.append(sorted_anis[chain_end])
+            chain_end = chain_previous[chain_end]
+        chain.reverse()
+
+    return chain
 
 
 def find_best_anis_combo(asc_name, anis):
@@ -57,14 +77,15 @@ def find_best_anis_combo(asc_name, anis):
         return anis
     reason = "best combination"
     # Full range from all animations
-    full_start = min(ani.first_frame for ani in anis)
+    sorted_anis = sorted(anis, key=lambda x: x.first_frame)
+    full_start = sorted_anis[0].first_frame
     full_end = max(ani.last_frame for ani in anis)
-    best_combo = []
-    for r in range(2, len(anis) + 1):
-        for combo in combinations(anis, r):
-            if is_continuous_and_non_overlapping(combo):
-                if len(combo) > len(best_combo):
-                    best_combo = combo
+
+    # common case, anis already follow each other without gaps or overlaps
+    if all(ani.first_frame == previous.last_frame + 1 for previous, ani in zip(sorted_anis, sorted_anis[1:])):
+        best_combo = sorted_anis
+    else:
+        best_combo = find_longest_anis_chain(sorted_anis, full_start, full_end)
 
     # no combo was found, find ani which uses biggest range
     if not best_combo:
@@ -79,26 +100,33 @@ def find_best_anis_combo(asc_name, anis):
             else:
                 best_combo = [notSpedUp[0]]
 
-    # best combo range
-    best_combo_start = min(ani.first_frame for ani in best_combo)
-    best_combo_end = max(ani.last_frame for ani in best_combo)
+    # best combo range, combo is either a chain in frame order or a single ani
+    best_combo_start = best_combo[0].first_frame
+    best_combo_end = best_combo[-1].last_frame
 
     remaining_anis = []
+    approximate = False
     if best_combo_start != full_start or best_combo_end != full_end:
         reason = "could not find combination covering full range"
-        best_combo = anis
+        # anis may overlap or leave gaps, they are still merged one after another in frame order
+        best_combo = sorted_anis
+        approximate = True
     
     if len(best_combo) != len(anis):
-        remaining_anis = [ani for ani in anis if ani not in best_combo]
+        best_combo_ids = {id(ani) for ani in best_combo}
+        remaining_anis = [ani for ani in anis if id(ani) not in best_combo_ids]
 
-    print(f"Reconstruct: {asc_name}")
-    print(f"-picked (reason: {reason}):")
+    # MSBs are converted in parallel, print the report at once so it is not interleaved with other workers
+    report_lines = [f"Reconstruct: {asc_name}", f"-picked (reason: {reason}):"]
     for ani in best_combo:
-        print(f"  ani: {ani.name}, Range: {ani.first_frame}-{ani.last_frame}")
+        report_lines.append(f"  ani: {ani.name}, Range: {ani.first_frame}-{ani.last_frame}")
     if remaining_anis:
-        print("-dropped:")
+        report_lines.append("-dropped:")
         for ani in remaining_anis:
-            print(f"  ani: {ani.name}, Range: {ani.first_frame}-{ani.last_frame}")
+            report_lines.append(f"  ani: {ani.name}, Range: {ani.first_frame}-{ani.last_frame}")
+    if approximate:
+        report_lines.append("-WARNING: picked anis overlap or leave gaps, merged animation is only approximate")
+    print('\n'.join(report_lines), flush=True)
     return best_combo
 
 
@@ -130,37 +158,35 @@ def parse_man(model_animation, mdh_dict):
                       'layer': model_animation.layer,
                       'source_script': {}, 'frames': {}}
 
-    bone_offset = 0
-    for sample_index, sample in enumerate(model_animation.samples):
-        if bone_offset >= len(model_animation.node_indices):
-            bone_offset = 0
-
-        bone_index = model_animation.node_indices[bone_offset]
+    # zenkit has no bulk accessor for samples, copy the raw structs once and read all fields in numpy
+    samples = np.frombuffer(b''.join(map(bytes, model_animation.samples)), dtype=animation_sample_dtype)
+    node_indices = model_animation.node_indices
 
-        bone_name = mdh_dict['nodes'][bone_index]['name']
-        if bone_name not in animation_data['frames']:
-            animation_data['frames'][bone_name] = {}
-            animation_data['frames'][bone_name]['translation'] = {}
-            animation_data['frames'][bone_name]['rotation'] = {}
+    # round in double precision, then keep float32 like the source data, orjson writes the arrays directly
+    translations = np.stack([samples['_position'][axis] for axis in 'xyz'], axis=1).astype(np.float64)
+    rotations = np.stack([samples['_rotation'][axis] for axis in 'xyzw'], axis=1).astype(np.float64)
+    translations = np.round(translations, 4).astype(np.float32)
+    rotations = np.round(rotations, 4).astype(np.float32)
 
-        translation = [sample.position.x, sample.position.y, sample.position.z]
-        rotation = [sample.rotation.x, sample.rotation.y, sample.rotation.z, sample.rotation.w]
+    # samples are stored frame by frame, one sample per animated node
+    bone_name_for_offset = [mdh_dict['nodes'][node_index]['name'] for node_index in node_indices]
+    for bone_offset, bone_name in enumerate(bone_name_for_offset):
+        animation_data['frames'][bone_name] = {}
+        animation_data['frames'][bone_name]['translation'] = np.ascontiguousarray(translations[bone_offset::len(node_indices)])
+        animation_data['frames'][bone_name]['rotation'] = np.ascontiguousarray(rotations[bone_offset::len(node_indices)])
 
-        translation = [rf(f) for f in translation]
-        rotation = [rf(f) for f in rotation]
-
-        animation_data['frames'][bone_name]['translation'][sample_index] = translation
-        animation_data['frames'][bone_name]['rotation'][sample_index] = rotation
+    return animation_data
 
-        bone_offset = bone_offset + 1
 
-    return animation_data
+@lru_cache(maxsize=None)
+def load_model_animation(man_file_path):
+    return ModelAnimation.load(man_file_path)
 
 
 def convert_anis(asc_name, mds_name, anis, man_file_paths, mdh_dict):
     model_animations = []
     for man_file in man_file_paths:
-        model_animation = ModelAnimation.load(man_file)
+        model_animation = load_model_animation(man_file)
         model_animations.append(model_animation)
     
     checksums = {ani.checksum for ani in model_animations}
@@ -172,46 +198,98 @@ def convert_anis(asc_name, mds_name, anis, man_file_paths, mdh_dict):
         print(f'ASC: {asc_name}, could not find correct MDH. ABORT')
         return
     
-    relative_path = man_file.relative_to(extract_path)
+    relative_path = Path(man_file).relative_to(extract_path)
     mdh = mdh_dict[checksum]
-    man_data_merged = {
-        'hierarchy': mdh,
-        'animation': {
-            'checksum': checksum,
-            'frame_count': model_animation.frame_count,
-            'fps': model_animation.fps,
-            'fps_source': model_animation.fps_source,
-            'layer': model_animation.layer,
-            'source_script': {},
-            'frames': {}}}
-
-    for model_animation in model_animations:
-        man_data = parse_man(model_animation, mdh)
-        for bone, tracks in man_data['frames'].items():
-            if bone not in man_data_merged['animation']['frames']:
-                man_data_merged['animation']['frames'][bone] = {
-                    'translation': {},
-                    'rotation': {}}
-            for trackName, trackFrames in tracks.items():
-                for frame, values in trackFrames.items():
-                    for v in values:
-                        man_data_merged['animation']['frames'][bone][trackName][frame]=v
-        
+    animation_header = {
+        'checksum': checksum,
+        # length of the appended tracks, overlapping anis are counted twice
+        'frame_count': sum(ani.frame_count for ani in model_animations),
+        'fps': model_animation.fps,
+        'fps_source': model_animation.fps_source,
+        'layer': model_animation.layer,
+        'source_script': {}}
+
+    man_data_list = [parse_man(model_animation, mdh) for model_animation in model_animations]
+    bone_names = dict.fromkeys(bone for man_data in man_data_list for bone in man_data['frames'])
+
     save_path = intermediate_path / (str(relative_path) + '.json')
     save_path.parent.mkdir(exist_ok=True, parents=True)
 
-    json_data = json.dumps(man_data, indent=4, ensure_ascii=False, sort_keys=False, default=str)
-    save_path.write_text(json_data, encoding='utf-8')
+    # hierarchy is shared by all anis of the same skeleton, encode it only once
+    if checksum not in mdh_json_by_checksum:
+        mdh_json_by_checksum[checksum] = orjson.dumps(mdh, option=json_options)
+
+    # frames are merged and written bone by bone, the whole merged animation is never held in memory
+    with save_path.open('wb') as file:
+        animation_json_data = orjson.dumps(animation_header, option=json_options)
+        file.write(b'{"hierarchy": ' + mdh_json_by_checksum[checksum] +
+                   b', "animation": ' + animation_json_data[:-1].rstrip() + b', "frames": {')
+
+        for bone_index, bone in enumerate(bone_names):
+            bone_tracks = {}
+            # anis are sorted by first frame and their frames are appended one after another,
+            # only exact if find_best_anis_combo found a contiguous combination
+            frame_offset = 0
+            for model_animation, man_data in zip(model_animations, man_data_list):
+                for trackName, trackFrames in man_data['frames'].get(bone, {}).items():
+                    track = bone_tracks.get(trackName, trackFrames[:0])
+                    if isinstance(track, np.ndarray) and len(track) == frame_offset:
+                        bone_tracks[trackName] = np.concatenate((track, trackFrames))
+                    else:
+                        # bone is not animated by some previous anis, empty frames keep it aligned
+                        bone_tracks[trackName] = list(track) + [[]] * (frame_offset - len(track)) + list(trackFrames)
+                frame_offset = frame_offset + model_animation.frame_count
+
+            if bone_index:
+                file.write(b', ')
+            file.write(orjson.dumps(bone) + b': ' + orjson.dumps(bone_tracks, option=json_options))
+
+        file.write(b'}}}')
 
     print(f'prepared: {relative_path}')
-    helpers.run_blender(blender_executable_file_path, blender_script_file_path)
-    print(f'[MODEL ANIMATION] End convert MAN via blender')
+    return save_path
 
 
 extract_path = None,
 intermediate_path = None
 convert_path = None
 blender_executable_file_path = None
+mdh_by_checksum = {}
+mdh_json_by_checksum = {}
+
+
+def init_msb_worker(extract_folder_path, intermediate_folder_path, mdh_dict):
+    global extract_path, intermediate_path, mdh_by_checksum
+    extract_path = extract_folder_path
+    intermediate_path = intermediate_folder_path
+    mdh_by_checksum = mdh_dict
+
+
+def convert_msb(msb_file_path, man_file_paths_by_stem):
+    mds_name = Path(msb_file_path).stem.upper().split('_')[0]
+    model_script = ModelScript.load(msb_file_path)
+    anis_by_asc_dict = parse_msb(model_script)
+    #relative_path = msb_file_path.relative_to(extract_path)
+    #save_path = convert_path / (str(relative_path) + '.json')
+    #save_path.parent.mkdir(exist_ok=True, parents=True)
+
+    # convert multiple anis to one asc
+    prepared_file_path_list = []
+    for asc_name, anis in anis_by_asc_dict.items():
+        ani_names = dict.fromkeys(ani.name for ani in anis)
+        man_files = [
+            path for ani_name in ani_names
+            for path in man_file_paths_by_stem.get(ani_name, [])
+        ]
+        save_path = convert_anis(asc_name, mds_name, anis, man_files, mdh_by_checksum)
+        if save_path:
+            prepared_file_path_list.append(save_path)
+
+    # every MSB is extracted into its own folder with its MAN files, don't keep them loaded
+    load_model_animation.cache_clear()
+
+    return prepared_file_path_list
+
 
 def convert():
     global extract_path, intermediate_path, convert_path, blender_executable_file_path
@@ -258,32 +336,50 @@ def convert():
     mdh_files = list(Path(intermediate_path).rglob(f'*.MDH.json'))
     mdh_by_checksum = defaultdict(list)
     for mdh_file in mdh_files:
-        mdh_data = mdh_file.read_text()
-        mdh_dict = json.loads(mdh_data)
+        mdh_dict = orjson.loads(mdh_file.read_bytes())
         checksum = mdh_dict['checksum']
         mdh_by_checksum[checksum] = mdh_dict
 
     ## 
-    msb_file_path_list = list(Path(extract_path).rglob(f'*.MSB'))
-
+    prepared_file_path_list = []
+    # collect MSB and MAN files in a single walk over the extract folder
+    msb_file_path_list = []
+    man_file_name_list_by_folder = defaultdict(list)
+    for folder, _, file_name_list in os.walk(extract_path):
+        for file_name in file_name_list:
+            if file_name.upper().endswith('.MSB'):
+                msb_file_path_list.append(os.path.join(folder, file_name))
+            elif file_name.upper().endswith('.MAN'):
+                man_file_name_list_by_folder[folder].append(file_name)
+
+    man_file_paths_by_stem_by_folder = {}
     for msb_file_path in msb_file_path_list:
-        msb_folder_path = msb_file_path.parent
-        man_file_path_list = list(Path(msb_folder_path).rglob(f'*.MAN'))
-        mds_name = msb_file_path.stem.upper().split('_')[0]
-        model_script = ModelScript.load(msb_file_path)
-        anis_by_asc_dict = parse_msb(model_script)
-        #relative_path = msb_file_path.relative_to(extract_path)
-        #save_path = convert_path / (str(relative_path) + '.json')
-        #save_path.parent.mkdir(exist_ok=True, parents=True)
-
-        # convert multiple anis to one asc
-        for asc_name, anis in anis_by_asc_dict.items():
-            ani_names = {ani.name for ani in anis}
-            man_files = [
-                path for path in man_file_path_list
-                if path.stem in ani_names
-            ]
-            convert_anis(asc_name, mds_name, anis, man_files, mdh_by_checksum)
+        msb_folder = os.path.dirname(msb_file_path)
+        if msb_folder not in man_file_paths_by_stem_by_folder:
+            man_file_paths_by_stem = defaultdict(list)
+            for folder, man_file_name_list in man_file_name_list_by_folder.items():
+                if folder == msb_folder or folder.startswith(msb_folder + os.sep):
+                    for man_file_name in man_file_name_list:
+                        man_file_stem = os.path.splitext(man_file_name)[0]
+                        man_file_paths_by_stem[man_file_stem].append(os.path.join(folder, man_file_name))
+            man_file_paths_by_stem_by_folder[msb_folder] = man_file_paths_by_stem
+
+    man_file_paths_by_stem_list = [man_file_paths_by_stem_by_folder[os.path.dirname(msb_file_path)]
+                                   for msb_file_path in msb_file_path_list]
+
+    # every MSB is converted independently, spread them over all cpu cores,
+    # default worker count is cpu count, capped at 61 on windows
+    with ProcessPoolExecutor(initializer=init_msb_worker,
+                             initargs=(extract_path, intermediate_path, mdh_by_checksum)) as executor:
+        for save_path_list in executor.map(convert_msb, msb_file_path_list, man_file_paths_by_stem_list):
+            prepared_file_path_list.extend(save_path_list)
+
+    # import_man.py converts every prepared MAN json in one blender session
+    if prepared_file_path_list:
+        blender_script_file_path = Path.cwd() / 'import_zengin_json' / 'import_man.py'
+        print(f'[MODEL ANIMATION] Start convert MAN via blender')
+        helpers.run_blender(blender_executable_file_path, blender_script_file_path)
+        print(f'[MODEL ANIMATION] End convert MAN via blender')
             
 
 if __name__ == '__main__':